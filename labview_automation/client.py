@@ -1,17 +1,67 @@
+from concurrent import futures
+import functools
 import socket
 import struct
+import warnings
 import bson
 
 
+if not bson.has_c():
+    warnings.warn("pymongo's bson C extension is not available; encoding and"
+                  " decoding LabVIEW messages will be slow.", RuntimeWarning)
+
+
+_CODEC_OPTIONS = bson.DEFAULT_CODEC_OPTIONS
+# Every BSON document starts with its total size as a little-endian int32
+_HEADER = struct.Struct('<i')
+_bson_encode = bson.encode
+_bson_decode = bson.decode
+_SOCKET_BUFFER_SIZE = 1 << 20
+# Smaller batched documents are merged into sends of at least this size
+_SEND_CHUNK_SIZE = 1 << 16
+
+
 class Error(Exception):
     """
     Class for errors which occur while calling a LabVIEW VI
     """
 
-    def __init__(self, code, source, message):
+    def __init__(self, code, source, message=None, describe=None):
+        """
+        :param code: LabVIEW error code
+        :param source: LabVIEW error source
+        :param message: Description of the error
+        :param describe: Callable that returns the description of the error.
+                         Used instead of message, and only called the first
+                         time the message is needed.
+        """
+        args = (code, source) if message is None else (code, source, message)
+        super(Error, self).__init__(*args)
         self.code = code
         self.source = source
-        self.message = message
+        self._message = message
+        self._describe = describe
+
+    @property
+    def message(self):
+        if self._message is None and self._describe is not None:
+            try:
+                self._message = self._describe()
+            except socket.error:
+                # The connection the error came from is gone
+                self._message = 'LabVIEW error {} in {}'.format(
+                    self.code, self.source)
+            self._describe = None
+            self.args = (self.code, self.source, self._message)
+        return self._message
+
+    def __str__(self):
+        return str(self.message)
+
+    def __reduce__(self):
+        # The describe callable holds on to the client, so only the args
+        # are pickled
+        return self.__class__, self.args
 
 
 class LabVIEWClient(object):
@@ -21,28 +71,53 @@ class LabVIEWClient(object):
     LabVIEW Listener component
     """
 
-    def __init__(self, address, port=2552):
+    def __init__(self, address, port=2552, describe_errors=True):
         """
         :param address: Address of the remote computer running the LVListener
                         eg. 10.2.13.32
         :param port: Port of the remote computer LVListener is listening on
                      (default: 2552)
+        :param describe_errors: Whether to ask the listener for the
+                                description of an error before raising it.
+                                If False the description is only fetched the
+                                first time the error's message is used, which
+                                saves a round trip for callers that don't use
+                                it but requires the client to still be
+                                connected at that point. (default: True)
         """
         self.address = address
         self.port = port
+        self.describe_errors = describe_errors
+        self._sender = None
 
     def __enter__(self):
         # Attempt to establish a TCP connection to the listener
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Commands are small request/response pairs, so don't let Nagle's
+        # algorithm hold them back. The buffer sizes must be set before
+        # connecting for the receive window to be negotiated with them.
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, _SOCKET_BUFFER_SIZE)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, _SOCKET_BUFFER_SIZE)
         s.connect((self.address, self.port))
         self.connection = s
+        # Reads go through a buffered file so that filling a packet loops in
+        # C and a small response usually arrives in a single recv.
+        self._rfile = s.makefile('rb')
         return self
 
     def __exit__(self, type, value, tb):
         # Only close the socket if this method is called. This enables the user
         # to call run_vi_synchronous multiple times on this object
         if self.connection:
+            # Shut the socket down before joining the sender thread, which
+            # may be blocked in sendall if a batch was interrupted.
+            self._abort_connection()
+            self._rfile.close()
             self.connection.close()
+        if self._sender:
+            self._sender.shutdown()
+            self._sender = None
 
     def _check_for_error(self, return_dict):
         """
@@ -55,10 +130,15 @@ class LabVIEWClient(object):
             error = {'code': return_dict['RunVIState_Code'],
                      'status': return_dict['RunVIState_Status'],
                      'source': return_dict['RunVIState_Source']}
+            if self.describe_errors:
+                raise Error(
+                    return_dict['RunVIState_Code'],
+                    return_dict['RunVIState_Source'],
+                    self.describe_error(error))
             raise Error(
                 return_dict['RunVIState_Code'],
                 return_dict['RunVIState_Source'],
-                self.describe_error(error))
+                describe=functools.partial(self.describe_error, error))
 
     def run_vi_synchronous(self, vi_path, control_values, run_options=0,
                            open_frontpanel=False, indicator_names=[]):
@@ -74,17 +154,56 @@ class LabVIEWClient(object):
                                 names of indicators to return. Returns all
                                 indicators if an empty list is specified.
         """
+        return self._call(
+            self._encode_run_vi(vi_path, control_values, run_options,
+                                open_frontpanel, indicator_names))
+
+    def run_vis_batch(self, calls):
+        """
+        Runs several VIs back to back. The commands are sent to the listener
+        without waiting for each result in turn, so the batch costs a single
+        network round trip.
+
+        :param calls: List of dictionaries, each holding the keyword
+                      arguments of run_vi_synchronous for one VI
+        :return: List of the returned indicator dictionaries, in the same
+                 order as calls
+        """
+        # Encode every command before sending any of them, so a call that
+        # can't be encoded fails without leaving unread responses behind.
+        bson_msgs = [self._encode_run_vi(**call) for call in calls]
+
+        # Read the responses while the commands are still being sent. The
+        # listener stops reading commands once it can't write its responses,
+        # so waiting for every send to finish first can deadlock.
+        sends = self._send_batch(bson_msgs)
+        try:
+            results = [self._recv_dict() for _ in bson_msgs]
+        except Exception:
+            # The connection is out of sync after a failed read. Shut it
+            # down so a send blocked on the listener returns instead of
+            # waiting forever for it to read more commands.
+            self._abort_connection()
+            futures.wait(sends)
+            raise
+        for send in sends:
+            send.result()
+        # Read every response before checking for errors so the connection
+        # is left in sync even if one of the VIs failed.
+        for return_vals in results:
+            self._check_for_error(return_vals)
+        return results
+
+    @staticmethod
+    def _encode_run_vi(vi_path, control_values, run_options=0,
+                       open_frontpanel=False, indicator_names=[]):
         msg = {'command': 'run_vi',
                'vi_path': vi_path,
                'run_options': run_options,
                'open_frontpanel': open_frontpanel,
                'control_values': control_values,
                'indicator_names': indicator_names}
-
-        self._send_dict(msg)
-        return_vals = self._recv_dict()
-        self._check_for_error(return_vals)
-        return return_vals
+        return _bson_encode(msg, codec_options=_CODEC_OPTIONS)
 
     def describe_error(self, error):
         """
@@ -94,7 +213,7 @@ class LabVIEWClient(object):
         """
         msg = {'command': 'describe_error',
                'error': error}
-        self._send_dict(msg)
+        self._send(_bson_encode(msg, codec_options=_CODEC_OPTIONS))
         return_vals = self._recv_dict()
         return return_vals['msg']
 
@@ -123,10 +242,8 @@ class LabVIEWClient(object):
                'control_values': control_values,
                'ignore_nonexistent_controls': ignore_nonexistent_controls}
 
-        self._send_dict(msg)
-        return_vals = self._recv_dict()
-        self._check_for_error(return_vals)
-        return return_vals
+        return self._call(
+            _bson_encode(msg, codec_options=_CODEC_OPTIONS))
 
     def get_indicators(self, project_path, target_name,
                        vi_path, indicator_names):
@@ -147,26 +264,85 @@ class LabVIEWClient(object):
                'vi_path': vi_path,
                'indicator_names': indicator_names}
 
-        self._send_dict(msg)
+        return self._call(
+            _bson_encode(msg, codec_options=_CODEC_OPTIONS))
+
+    def _call(self, bson_msg):
+        """
+        Sends an encoded command and returns the listener's response. Raises
+        an error if the command failed.
+        """
+        self._send(bson_msg)
         return_vals = self._recv_dict()
         self._check_for_error(return_vals)
         return return_vals
 
+    def _recv_into(self, view):
+        """
+        Fills the given memoryview with bytes from the socket, waiting until
+        every byte has arrived.
+        """
+        if self._rfile.readinto(view) != len(view):
+            raise socket.error('Connection closed by the LabVIEW Listener')
+
     def _recv_dict(self):
         if self.connection:
-            packet_size = self.connection.recv(4)
-            packet_size_int = struct.unpack('<l', packet_size)[0]
             # First part of packet will be the 4-byte packet size
-            packet = packet_size
-            while len(packet) < packet_size_int:
-                partial_packet = self.connection.recv(
-                    packet_size_int - len(packet))
-                if not partial_packet:
-                    break
-                packet += partial_packet
-            return bson.decode_all(packet)[0]
-
-    def _send_dict(self, msg):
+            header = bytearray(_HEADER.size)
+            self._recv_into(memoryview(header))
+            packet_size = _HEADER.unpack_from(header)[0]
+            packet = bytearray(packet_size)
+            packet[:_HEADER.size] = header
+            self._recv_into(memoryview(packet)[_HEADER.size:])
+            return _bson_decode(bytes(packet), codec_options=_CODEC_OPTIONS)
+
+    def _abort_connection(self):
+        """
+        Shuts down both directions of the socket, waking up any thread that
+        is blocked sending or receiving on it.
+        """
+        try:
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            # Already shut down or disconnected
+            pass
+
+    def _send(self, bson_msg):
+        if self.connection:
+            self.connection.sendall(bson_msg)
+
+    def _send_batch(self, bson_msgs):
+        """
+        Starts sending a list of encoded messages on the sender thread.
+
+        :return: List of futures that complete as the messages are sent
+        """
+        sends = []
         if self.connection:
-            bson_msg = bson.BSON.encode(msg)
-            self.connection.send(bson_msg)
+            if self._sender is None:
+                self._sender = futures.ThreadPoolExecutor(max_workers=1)
+            # Sending happens on a worker thread so that it overlaps with
+            # the caller reading the responses. Documents of at least
+            # _SEND_CHUNK_SIZE are sent as they are; smaller ones are merged
+            # so they still go out together. Each BSON document carries its
+            # own size, so the listener can split the concatenated documents
+            # back into separate commands.
+            pending = bytearray()
+            for bson_msg in bson_msgs:
+                if len(bson_msg) >= _SEND_CHUNK_SIZE:
+                    if pending:
+                        sends.append(self._sender.submit(
+                            self.connection.sendall, pending))
+                        pending = bytearray()
+                    sends.append(self._sender.submit(
+                        self.connection.sendall, bson_msg))
+                    continue
+                pending += bson_msg
+                if len(pending) >= _SEND_CHUNK_SIZE:
+                    sends.append(self._sender.submit(
+                        self.connection.sendall, pending))
+                    pending = bytearray()
+            if pending:
+                sends.append(self._sender.submit(
+                    self.connection.sendall, pending))
+        return sends
@@ -1,21 +1,35 @@
-import ConfigParser
-from distutils.dir_util import copy_tree
+import asyncio
+import functools
 from hoplite.remote_enabler import remotify
 import logging
 import os
 import platform
 import psutil
+import shutil
+import socket
 import stat
-import subprocess
 import tempfile
 import time
 
+try:
+    import winreg
+except ImportError:
+    # The registry is only queried on Windows
+    winreg = None
+
 from labview_automation.client import LabVIEWClient
 
 
 _log = logging.getLogger(__name__)
 _log.addHandler(logging.NullHandler())
 
+_DEFAULT_VI_SEARCH_PATH = \
+    r"<topvi>:\*;<foundvi>:\;<vilib>:\*;<userlib>:\*;<instrlib>:\*"
+
+_PROBE_TIMEOUT_S = 1.0
+_PROBE_INITIAL_DELAY_S = 0.05
+_PROBE_MAX_DELAY_S = 2.0
+
 
 class Error(Exception):
     pass
@@ -128,6 +142,7 @@ class LabVIEW(object):
         self._bitness = bitness
         self._pid = None
         self.ini = _LVOptions()
+        self._search_paths = None
         self._server_cfg = ServerConfiguration(
             start_with_server,
             server_port,
@@ -200,24 +215,34 @@ class LabVIEW(object):
     def disable_ni_error_reporting(self):
         self.ini.NIER = False
 
-    def add_to_search_path(self, path, append=False):
-        ini_paths = ''
+    def _get_search_paths(self):
+        """
+        Returns the entries of the viSearchPath token as a list and a set.
+        The token is only parsed again if it was changed by something other
+        than add_to_search_path.
+        """
         try:
             ini_paths = self.ini.viSearchPath
         except AttributeError:
-            ini_paths = r"<topvi>:\*;<foundvi>:\;<vilib>:\*;<userlib>:\*;<instrlib>:\*"
+            ini_paths = _DEFAULT_VI_SEARCH_PATH
+
+        if (self._search_paths is None or
+                self._search_paths[0] != ini_paths):
+            paths = [p for p in ini_paths.strip('"\'').split(';') if p]
+            self._search_paths = (ini_paths, paths, set(paths))
+        return self._search_paths[1], self._search_paths[2]
 
-        ini_paths = ini_paths.strip('"\'')
-        ini_paths = ini_paths.split(';')
-        if path not in ini_paths:
+    def add_to_search_path(self, path, append=False):
+        paths, path_set = self._get_search_paths()
+        if path not in path_set:
             if append:
-                ini_paths.append(path)
+                paths.append(path)
             else:
-                ini_paths.insert(0, path)
-
-        ini_paths = '"{}"'.format(
-            (';' if len(ini_paths) > 2 else '').join(ini_paths))
+                paths.insert(0, path)
+            path_set.add(path)
 
+        ini_paths = '"{}"'.format(';'.join(paths))
+        self._search_paths = (ini_paths, paths, path_set)
         self.ini.viSearchPath = ini_paths
 
     def set_number_of_execution_threads(self, number_of_threads):
@@ -230,18 +255,20 @@ class LabVIEW(object):
 
     def copy_to_labview_dir(self, source, relative_destination):
         labview_path = os.path.join(self.path, relative_destination)
-        self._helpers.copy_tree(source, labview_path)
-        self._helpers.make_writable(labview_path)
+        self._helpers.deploy_tree(source, labview_path)
         return labview_path
 
     def start(self, wait_until_open=True, timeout_s=900):
-        ini_file = self._helpers.create_temp_ini(self.ini.get_dict())
-        if self.server_cfg.start:
-            if self.is_running():
-                _log.warning("This LabVIEW instance was already launched.")
+        # Check for a running instance first so that relaunching doesn't
+        # create an ini file or look up the listener path for nothing.
+        if self.is_running():
+            _log.warning("This LabVIEW instance was already launched.")
+            if self.server_cfg.start:
                 with self.client():
                     pass
-                return
+            return
+        ini_file = self._helpers.create_temp_ini(self.ini.get_dict())
+        if self.server_cfg.start:
             server_vi_path = self._helpers.get_listener_vi_path()
             args = [server_vi_path,
                     '-pref',
@@ -260,14 +287,25 @@ class LabVIEW(object):
                 self.wait_until_server_loaded(
                     timeout_s, port=self.server_cfg.port)
         else:
-            if self.is_running():
-                _log.warning("This LabVIEW instance was already launched.")
-                return
             self._pid = self._helpers.start_process([
                 self.executable,
                 '-pref',
                 ini_file])
 
+    async def start_async(self, wait_until_open=True, timeout_s=900):
+        """
+        Coroutine version of start. Launching runs in the default executor
+        and waiting for the server doesn't block the event loop, so several
+        instances can be started together with asyncio.gather.
+        """
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(
+            None, functools.partial(self.start, wait_until_open=False,
+                                    timeout_s=timeout_s))
+        if wait_until_open and self.server_cfg.start:
+            await self.wait_until_server_loaded_async(
+                timeout_s, port=self.server_cfg.port)
+
     def restart(self, wait_until_open=True, timeout_s=900):
         if self.is_running():
             self.kill(timeout_s)
@@ -294,18 +332,49 @@ class LabVIEW(object):
             Default is 15 minutes (900 seconds).
         :raises TimeoutError: Raised when timeout exceeded while waiting
         """
-        waiting = True
+        # Probe with a bare TCP connect and back off between attempts rather
+        # than spinning on full client connections while LabVIEW launches.
+        delay = _PROBE_INITIAL_DELAY_S
         start_time = time.time()
-        while waiting:
+        while True:
             try:
-                with self.client():
-                    pass
-            except Exception:
+                probe = socket.create_connection(
+                    (self._host, port), timeout=_PROBE_TIMEOUT_S)
+            except socket.error:
+                if time.time() - start_time > timeout_s:
+                    raise TimeoutError('Timed out while waiting for LabVIEW'
+                                       ' server to load')
+                time.sleep(delay)
+                delay = min(delay * 1.5, _PROBE_MAX_DELAY_S)
+            else:
+                probe.close()
+                return
+
+    async def wait_until_server_loaded_async(self, timeout_s=900, port=2552):
+        """
+        Coroutine version of wait_until_server_loaded.
+
+        :param timeout_s: How long to wait for the LabVIEW server to load.
+            Default is 15 minutes (900 seconds).
+        :raises TimeoutError: Raised when timeout exceeded while waiting
+        """
+        delay = _PROBE_INITIAL_DELAY_S
+        start_time = time.time()
+        while True:
+            try:
+                _, probe = await asyncio.wait_for(
+                    asyncio.open_connection(self._host, port),
+                    _PROBE_TIMEOUT_S)
+            except (OSError, asyncio.TimeoutError):
                 if time.time() - start_time > timeout_s:
                     raise TimeoutError('Timed out while waiting for LabVIEW'
                                        ' server to load')
+                await asyncio.sleep(delay)
+                delay = min(delay * 1.5, _PROBE_MAX_DELAY_S)
             else:
-                waiting = False
+                probe.close()
+                await probe.wait_closed()
+                return
 
     def kill(self, timeout_s=None):
         self._helpers.kill_process(self._pid, self.executable, timeout_s)
@@ -314,6 +383,10 @@ class LabVIEW(object):
 
 @remotify(__name__)
 class LabVIEWHelpers(object):
+    _labview_paths = None
+    # Processes we have started or verified, keyed by pid
+    _processes = {}
+
     def is_os_64bit(self):
         return platform.machine().endswith('64')
 
@@ -333,9 +406,13 @@ class LabVIEWHelpers(object):
                                       ' Windows platforms')
 
     def _get_labview_paths_windows(self):
+        # The installed versions don't change while we're running, so only
+        # walk the registry once per process.
+        if LabVIEWHelpers._labview_paths is not None:
+            return list(LabVIEWHelpers._labview_paths)
+
         # Connect to the registry at the root of the LabVIEW key
-        import _winreg
-        reg = _winreg.ConnectRegistry(None, _winreg.HKEY_LOCAL_MACHINE)
+        reg = winreg.ConnectRegistry(None, winreg.HKEY_LOCAL_MACHINE)
 
         installed_lv_paths = []
         # Iterate over all subkeys until you find one that isn't a version
@@ -346,54 +423,50 @@ class LabVIEWHelpers(object):
                          r"SOFTWARE\National Instruments\LabVIEW"]:
             try:
                 key = self._open_windows_native_key(reg, root_key)
-                i = 0
-                current_lv_version = _winreg.EnumKey(key, i)
-                while current_lv_version.find('.') != -1:
-                    try:
-                        current_lv_reg_key = self._open_windows_native_key(
-                            reg, root_key + "\\" + current_lv_version)
-                        value, key_type = _winreg.QueryValueEx(
-                            current_lv_reg_key, "PATH")
-                    except WindowsError as e:
-                        if e.errno == 2:
-                            pass
-                    else:
-                        installed_lv_paths.append(value)
-                    finally:
-                        i += 1
-                        try:
-                            current_lv_version = _winreg.EnumKey(key, i)
-                        except (IOError, WindowsError):
-                            break
-            except WindowsError as e:
+            except WindowsError:
                 # If the key doesn't exist LabVIEW may not be installed.  We
                 # can safely ignore this error
-                pass
-
+                continue
+            # Ask for the number of subkeys up front rather than enumerating
+            # until EnumKey fails
+            subkey_count = winreg.QueryInfoKey(key)[0]
+            for i in range(subkey_count):
+                current_lv_version = winreg.EnumKey(key, i)
+                if '.' not in current_lv_version:
+                    break
+                try:
+                    # Open the version relative to the already open root key
+                    current_lv_reg_key = self._open_windows_native_key(
+                        key, current_lv_version)
+                    value, key_type = winreg.QueryValueEx(
+                        current_lv_reg_key, "PATH")
+                except WindowsError:
+                    continue
+                installed_lv_paths.append(value)
+
+        LabVIEWHelpers._labview_paths = tuple(installed_lv_paths)
         return installed_lv_paths
 
     def _open_windows_native_key(self, key, sub_key):
         """
         Opens a windows registry key using the OS bitness-based version of the
         registry view.
-        This method eventually calls the _winreg.OpenKey() method.
+        This method eventually calls the winreg.OpenKey() method.
 
         This is useful because if we're running a 32-bit python interpreter, by
-        default _winreg accesses the 32-bit registry view. This is a problem on
+        default winreg accesses the 32-bit registry view. This is a problem on
         64-bit OSes as it limits us to registries of 32-bit applications.
         """
-        import _winreg
-
         python_bitness, linkage = platform.architecture()
 
-        # If we're running 32-bit python, by default _winreg accesses the
+        # If we're running 32-bit python, by default winreg accesses the
         # 32-bit registry view. This is a problem on 64-bit OSes.
         if python_bitness == '32bit' and platform.machine().endswith('64'):
-            # Force _winreg to access the 64-bit registry view with the access
-            # map as _winreg.KEY_WOW64_64KEY
-            return _winreg.OpenKey(key, sub_key, 0, _winreg.KEY_READ | _winreg.KEY_WOW64_64KEY)
+            # Force winreg to access the 64-bit registry view with the access
+            # map as winreg.KEY_WOW64_64KEY
+            return winreg.OpenKey(key, sub_key, 0, winreg.KEY_READ | winreg.KEY_WOW64_64KEY)
         else:
-            return _winreg.OpenKey(key, sub_key)
+            return winreg.OpenKey(key, sub_key)
 
         return key
 
@@ -415,18 +488,16 @@ class LabVIEWHelpers(object):
 
     def _get_active_labview_windows(self):
         # Connect to the registry at the root of the LabVIEW key
-        import _winreg
-
-        reg = _winreg.ConnectRegistry(None, _winreg.HKEY_LOCAL_MACHINE)
+        reg = winreg.ConnectRegistry(None, winreg.HKEY_LOCAL_MACHINE)
         try:
             key = self._open_windows_native_key(
                 reg, r"SOFTWARE\National Instruments\LabVIEW\CurrentVersion")
-            value, key_type = _winreg.QueryValueEx(key, "PATH")
+            value, key_type = winreg.QueryValueEx(key, "PATH")
         except WindowsError:
             key = self._open_windows_native_key(
                 reg,
                 r"SOFTWARE\Wow6432Node\National Instruments\LabVIEW\CurrentVersion")
-            value, key_type = _winreg.QueryValueEx(key, "PATH")
+            value, key_type = winreg.QueryValueEx(key, "PATH")
         return value
 
     def get_listener_vi_path(self):
@@ -443,7 +514,8 @@ class LabVIEWHelpers(object):
         """
         Starts a process using Popen and returns its pid.
         """
-        proc = subprocess.Popen(args)
+        proc = psutil.Popen(args)
+        LabVIEWHelpers._processes[proc.pid] = proc
         return proc.pid
 
     def _get_process(self, pid, executable):
@@ -459,56 +531,92 @@ class LabVIEWHelpers(object):
         remote and usually irrelevant to our use-cases anyway that I'm
         allowing it here.
 
+        The process is cached once it has been checked so later calls don't
+        need to query the exe again. psutil.Process.is_running() also
+        compares creation times, so a cached process is never confused with
+        a new one that reused its pid.
+
         Returns:
             psutil.Process if exists, None otherwise
         """
 
         if pid is None:
             return None
+        proc = LabVIEWHelpers._processes.get(pid)
+        if proc is not None:
+            return proc
         try:
             proc = psutil.Process(pid)
-            if proc.exe().lower() == executable.lower():
-                return proc
-            return None
+            if proc.exe().lower() != executable.lower():
+                return None
         except psutil.NoSuchProcess:
             return None
+        LabVIEWHelpers._processes[pid] = proc
+        return proc
 
     def process_is_running(self, pid, executable):
         proc = self._get_process(pid, executable)
         if proc is None:
             return False
-        return proc.is_running()
+        if not proc.is_running():
+            LabVIEWHelpers._processes.pop(pid, None)
+            return False
+        return True
 
     def get_process_memory_usage(self, pid, executable):
         proc = self._get_process(pid, executable)
         if proc is None:
             return 0
-        return proc.memory_info()[0]
+        try:
+            return proc.memory_info()[0]
+        except psutil.NoSuchProcess:
+            LabVIEWHelpers._processes.pop(pid, None)
+            return 0
 
     def kill_process(self, pid, executable, timeout=None):
         proc = self._get_process(pid, executable)
         if proc is None:
             return  # Process not running, just exit.
+        LabVIEWHelpers._processes.pop(pid, None)
+        if not proc.is_running():
+            return
         proc.kill()
         proc.wait(timeout)
 
     def copy_tree(self, source, destination):
-        copy_tree(source, destination)
+        # copyfile skips the metadata copy that the default copy2 does
+        shutil.copytree(source, destination, copy_function=shutil.copyfile,
+                        dirs_exist_ok=True)
+
+    def make_writable(self, directory):
+        for root, dirs, files in os.walk(directory):
+            for name in files:
+                path = os.path.join(root, name)
+                os.chmod(path, os.stat(path).st_mode | stat.S_IWUSR)
 
-    def make_writable(directory):
-        os.chmod(directory, stat.S_IWUSR & stat.S_IWOTH)
+    def deploy_tree(self, source, destination):
+        """
+        Copies a directory tree so that the copied files are writable, in a
+        single pass over the tree. copyfile doesn't copy permission bits, so
+        the new files get the default, owner-writable mode even if the
+        source files are read-only.
+        """
+        shutil.copytree(source, destination, copy_function=shutil.copyfile,
+                        dirs_exist_ok=True)
 
     def create_temp_ini(self, options={}):
-        ini = ConfigParser.RawConfigParser()
-        # iterate over sections
-        for section, tokens in options.iteritems():
-            ini.add_section(section)
-            for key, value in tokens.iteritems():
-                ini.set(section, key, value)
+        # The ini only ever holds plain key/value tokens, so write it out
+        # directly rather than building it up in a ConfigParser.
+        lines = []
+        for section, tokens in options.items():
+            lines.append('[{}]\n'.format(section))
+            lines.extend('{} = {}\n'.format(key, value)
+                         for key, value in tokens.items())
+            lines.append('\n')
 
         fd, path = tempfile.mkstemp(suffix=".ini")
         with os.fdopen(fd, 'w') as f:
-            ini.write(f)
+            f.write(''.join(lines))
         return path
 
 
@@ -549,5 +657,8 @@ class RemoteLabVIEWHelpers(object):
     def make_writable(self, directory):
         self.helpers.remote_make_writable(self.host, directory)
 
+    def deploy_tree(self, source, destination):
+        self.helpers.remote_deploy_tree(self.host, source, destination)
+
     def create_temp_ini(self, tokens=[]):
         return self.helpers.remote_create_temp_ini(self.host, tokens)
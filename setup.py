@@ -10,5 +10,6 @@ setup(name='labview_automation',
       license='MIT',
       include_package_data=True,
       packages=['labview_automation', 'lv_listener'],
-      install_requires=['psutil', 'pymongo', 'hoplite>=15.0.0.dev11']
+      python_requires='>=3.8',
+      install_requires=['psutil', 'pymongo>=3.9', 'hoplite>=15.0.0.dev11']
       )